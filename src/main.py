@@ -2,26 +2,57 @@ import os
 import re
 import shutil
 import subprocess
+import tempfile
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+# PyAV is optional: when installed, remuxing happens in-process, otherwise ffmpeg is launched per file
+try:
+    import av
+except ImportError:
+    av = None
 
 from operations import Operations
 
 PREFERRED_VIDEO_EXTENSION = '.mkv'
 
-VIDEO_EXTENSIONS = [
+VIDEO_EXTENSIONS = frozenset({
     '.avi', '.mkv', '.mov', '.mp4', '.webm', '.wmv'
-]
+})
+
+_FOLDER_RE = re.compile(r'^(?P<title>.+) \((?P<year>\d{4})\)$')
+
+REMUXABLE_VIDEO_CODECS = frozenset({
+    'h264', 'hevc'
+})
+
+HWACCEL_ENCODERS = {
+    'nvenc': (['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda'], ['-c:v', 'h264_nvenc', '-preset', 'p5']),
+    'vaapi': (['-hwaccel', 'vaapi', '-hwaccel_device', '/dev/dri/renderD128', '-hwaccel_output_format', 'vaapi'], ['-vf', 'format=nv12|vaapi,hwupload', '-c:v', 'h264_vaapi']),
+    'qsv': (['-hwaccel', 'qsv', '-hwaccel_output_format', 'qsv'], ['-c:v', 'h264_qsv']),
+}
+
+# Number of trailing encoder stderr lines reported when an encode fails
+ENCODER_ERROR_LINES = 3
+
+# Consumer GPUs only allow a couple of concurrent encode sessions
+HWACCEL_MAX_JOBS = 2
 
 def main():
     argument_parser = ArgumentParser()
     argument_parser.add_argument('folder_path', help='Path to pre-named folder containing the movie files')
     argument_parser.add_argument('-m', '--many', help='Indicates that the provided folder contains many folders that should be processed', action='store_true')
     argument_parser.add_argument('--whatIf', help='Display changes that would be made. Does not modify any files.', action='store_false')
+    argument_parser.add_argument('-j', '--jobs', help='Number of folders to process in parallel when using --many', type=int, default=1)
+    argument_parser.add_argument('--encoder-threads', help='Threads per Handbrake transcode. Defaults to the CPU count divided by --jobs when processing --many folders in parallel', type=int)
 
+    # With neither flag, H.264/HEVC sources are remuxed and everything else is transcoded
     operations_group = argument_parser.add_mutually_exclusive_group()
     operations_group.add_argument('--transcode', help='Indicates that the video files should be transcoded to MKV', action='store_true')
     operations_group.add_argument('--remux', help='Indicates that the video files should be remuxed to MKV', action='store_true')
 
+    argument_parser.add_argument('--hwaccel', help='Transcode with ffmpeg on the given hardware encoder instead of Handbrake', choices=sorted(HWACCEL_ENCODERS))
+
     arguments = argument_parser.parse_args()
 
     contains_many = arguments.many
@@ -29,34 +60,52 @@ def main():
     folder_path = os.path.normpath(arguments.folder_path)
     transcode = arguments.transcode
     remux = arguments.remux
+    jobs = arguments.jobs
+    hwaccel = arguments.hwaccel
+
+    assert jobs >= 1, 'Job count must be at least 1'
+    assert not (remux and hwaccel is not None), '--hwaccel only applies to transcodes and cannot be combined with --remux'
 
-    assert transcode is True or remux is True, 'An operations must be specified'
+    # Without --remux any folder may need a transcode, and each one holds a GPU encode session
+    if hwaccel is not None and contains_many and jobs > HWACCEL_MAX_JOBS:
+        print(f'Limiting to {HWACCEL_MAX_JOBS} jobs because {hwaccel} transcodes are limited to {HWACCEL_MAX_JOBS} concurrent encode sessions')
+        jobs = HWACCEL_MAX_JOBS
 
-    operation = Operations.TRANSCODE if transcode else Operations.REMUX
+    # A single job keeps the encoder's own thread heuristic; parallel jobs split the CPUs between them
+    encoder_threads = arguments.encoder_threads
+    if encoder_threads is None and contains_many and jobs > 1:
+        encoder_threads = max(1, (os.cpu_count() or 1) // jobs)
+    assert encoder_threads is None or encoder_threads >= 1, 'Encoder thread count must be at least 1'
+
+    if transcode:
+        operation = Operations.TRANSCODE
+    elif remux:
+        operation = Operations.REMUX
+    else:
+        operation = Operations.AUTO
 
     requires_manual_intervention = dict()
 
     if contains_many:
-        proc_count = 0
-        listed_dir = sorted([f for f in os.listdir(folder_path) if not f.startswith('.')])
-        for dir_entry in listed_dir:
-            dir_entry_path = os.path.join(folder_path, dir_entry)
-            if os.path.isdir(dir_entry_path):
-                proc_count += 1
-                print(f'[{proc_count} of {len(listed_dir)}] Processing {dir_entry_path}')
-                processed, error = process_folder(dir_entry_path, operation, modify=should_modify)
-                if not processed:
-                    requires_manual_intervention[dir_entry_path] = error
-                    print('\tRequires manual intervention:')
-                    print(f'\t\t{error}\n')
-        pass
+        with os.scandir(folder_path) as dir_entries:
+            dir_entry_paths = sorted(e.path for e in dir_entries if not e.name.startswith('.') and e.is_dir())
+        total = len(dir_entry_paths)
+        if jobs == 1:
+            for proc_count, dir_entry_path in enumerate(dir_entry_paths, 1):
+                print(f'[{proc_count} of {total}] Processing {dir_entry_path}')
+                result = process_folder(dir_entry_path, operation, hwaccel=hwaccel, encoder_threads=encoder_threads, modify=should_modify)
+                report_folder_result(dir_entry_path, result, requires_manual_intervention)
+        else:
+            tasks = ((dir_entry_path, operation, hwaccel, encoder_threads, should_modify) for dir_entry_path in dir_entry_paths)
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = executor.map(process_folder_star, tasks)
+                for proc_count, (dir_entry_path, result) in enumerate(zip(dir_entry_paths, results), 1):
+                    print(f'[{proc_count} of {total}] Processing {dir_entry_path}')
+                    report_folder_result(dir_entry_path, result, requires_manual_intervention)
     else:
         print(f'Processing {folder_path}')
-        processed, error = process_folder(folder_path, operation, modify=should_modify)
-        if not processed:
-            requires_manual_intervention[folder_path] = error
-            print('\tRequires manual intervention:')
-            print(f'\t\t{error}\n')
+        result = process_folder(folder_path, operation, hwaccel=hwaccel, encoder_threads=encoder_threads, modify=should_modify)
+        report_folder_result(folder_path, result, requires_manual_intervention)
 
     if len(requires_manual_intervention) > 0:
         print('\n')
@@ -68,102 +117,207 @@ def main():
     
     print('Done')
 
-def process_folder(folder_path, operation, modify=False):
+def report_folder_result(folder_path, result, requires_manual_intervention):
+    processed, error, messages = result
+    for message in messages:
+        print(f'\t{message}')
+    if not processed:
+        requires_manual_intervention[folder_path] = error
+        print('\tRequires manual intervention:')
+        print(f'\t\t{error}')
+    print('\n')
+
+def process_folder_star(task):
+    folder_path, operation, hwaccel, encoder_threads, modify = task
+    return process_folder(folder_path, operation, hwaccel=hwaccel, encoder_threads=encoder_threads, modify=modify)
+
+def process_folder(folder_path, operation, hwaccel=None, encoder_threads=None, modify=False):
+    # Messages are returned rather than printed so parallel workers don't interleave their output
+    messages = []
     try:
-        assert check_proper_folder_name(folder_path), 'Improper folder name'
+        folder_name = os.path.basename(folder_path)
+        parsed_folder_name = parse_folder_name(folder_name)
+        assert parsed_folder_name is not None, 'Improper folder name'
+        title, year = parsed_folder_name
 
-        possible_video_matches = find_proper_video(folder_path)
+        dir_entries = _scan(folder_path)
+
+        possible_video_matches = find_proper_video(dir_entries, year)
         
         assert len(possible_video_matches) == 1, 'Could not automatically isolate correct video'
         video_path = possible_video_matches[0]
+        current_name, current_extension = os.path.splitext(os.path.basename(video_path))
 
-        renamed_video_path, rename_message = rename_proper_video(folder_path, video_path, modify=modify)
-        print(f'\t{rename_message}')
+        if operation == Operations.AUTO and current_extension != PREFERRED_VIDEO_EXTENSION:
+            operation = Operations.REMUX if _probe_video_codec(video_path) in REMUXABLE_VIDEO_CODECS else Operations.TRANSCODE
 
-        converted_path, convert_message = convert_proper_video(folder_path, renamed_video_path, operation, modify=modify)
-        print(f'\t{convert_message}')
+        renamed_video_path, rename_message = rename_proper_video(folder_path, folder_name, video_path, current_name, current_extension, modify=modify)
+        messages.append(rename_message)
 
-        delete_messages = delete_excess_files(folder_path, converted_path, modify=modify)
-        for message in delete_messages:
-            print(f'\t{message}')
+        converted_path, convert_message = convert_proper_video(folder_path, renamed_video_path, folder_name, current_extension, operation, hwaccel=hwaccel, encoder_threads=encoder_threads, modify=modify)
+        messages.append(convert_message)
 
-        print('\n')
+        messages.extend(delete_excess_files(dir_entries, converted_path, renamed_paths={video_path: renamed_video_path}, modify=modify))
 
-        return (True, None)
+        return (True, None, messages)
     except AssertionError as ae:
-        return (False, str(ae))
+        return (False, str(ae), messages)
+    except Exception as e:
+        # Anything else (e.g. an OSError while renaming or deleting) is reported for this folder
+        # instead of aborting the batch with the remaining folders half-processed
+        return (False, f'{type(e).__name__}: {e}', messages)
 
 
-def check_proper_folder_name(folder_path):
-    folder_name = os.path.basename(folder_path)
-    is_proper = re.match(r'^.+ \(\d\d\d\d\)$', folder_name) != None
-    is_proper = not '.' in folder_path
-    return is_proper
+def parse_folder_name(folder_name):
+    if '.' in folder_name:
+        return None
+    match = _FOLDER_RE.match(folder_name)
+    if match is None:
+        return None
+    return (match.group('title'), int(match.group('year')))
 
-def extract_year(folder_path):
-    folder_name = os.path.basename(folder_path)
-    year_str = re.search(r'\(\d\d\d\d\)', folder_name).group()
-    year = int(year_str[1:-1])
-    return year
-
-def find_proper_video(folder_path):
-    year = extract_year(folder_path)
+def _scan(folder_path):
+    with os.scandir(folder_path) as dir_entries:
+        return list(dir_entries)
 
+def find_proper_video(dir_entries, year):
     video_file_matches = []
-    for dir_entry_name in os.listdir(folder_path):
-        dir_entry_path = os.path.join(folder_path, dir_entry_name)
-        if not os.path.isdir(dir_entry_path):
-            name, extension = os.path.splitext(dir_entry_name)
-            if extension in VIDEO_EXTENSIONS:
+    for dir_entry in dir_entries:
+        if not dir_entry.is_dir(follow_symlinks=False):
+            name, dot, extension = dir_entry.name.rpartition('.')
+            if name and f'{dot}{extension}' in VIDEO_EXTENSIONS:
                 if str(year) in name:
-                    video_file_matches.append(dir_entry_path)
+                    video_file_matches.append(dir_entry.path)
 
     return video_file_matches
 
-def rename_proper_video(folder_path, video_path, modify=False):
-    new_name, new_extension = os.path.splitext(os.path.basename(folder_path))
-    current_name, current_extension = os.path.splitext(os.path.basename(video_path))
+def rename_proper_video(folder_path, new_name, video_path, current_name, current_extension, modify=False):
     new_video_path = os.path.join(folder_path, f'{new_name}{current_extension}')
+    if video_path == new_video_path:
+        return (video_path, f'{current_name}{current_extension} already named correctly')
 
     if modify:
-        os.rename(video_path, new_video_path)
+        os.replace(video_path, new_video_path)
         return (new_video_path, f'[RENAMED] {current_name}{current_extension} to {new_name}{current_extension}')
     else:
         return (new_video_path, f'Rename {current_name}{current_extension} to {new_name}{current_extension}')
 
-def convert_proper_video(folder_path, video_path, operation, modify=False):
-    current_name, current_extension = os.path.splitext(os.path.basename(video_path))
+def convert_proper_video(folder_path, video_path, current_name, current_extension, operation, hwaccel=None, encoder_threads=None, modify=False):
     if current_extension == PREFERRED_VIDEO_EXTENSION:
         return (video_path, f'{current_name}{current_extension} already encoded as {PREFERRED_VIDEO_EXTENSION}')
     new_video_path = os.path.join(folder_path, f'{current_name}{PREFERRED_VIDEO_EXTENSION}')
 
     if operation == Operations.TRANSCODE:
         if modify:
-            subprocess.run(args=['handbrake', '-i', video_path, '--preset', 'H.264 MKV 1080p30', '-o', new_video_path], check=True)
-            return (new_video_path, f'[TRANSCODED] {current_name}{current_extension} to {current_name}{PREFERRED_VIDEO_EXTENSION}\n\n\n')
+            if hwaccel is not None:
+                input_args, output_args = HWACCEL_ENCODERS[hwaccel]
+                _run_encoder(['ffmpeg', *input_args, '-i', video_path, *output_args, '-c:a', 'copy', new_video_path], new_video_path)
+            else:
+                thread_args = ['--encopts', f'threads={encoder_threads}'] if encoder_threads is not None else []
+                _run_encoder(['handbrake', '-i', video_path, '--preset', 'H.264 MKV 1080p30', *thread_args, '-o', new_video_path], new_video_path)
+            return (new_video_path, f'[TRANSCODED] {current_name}{current_extension} to {current_name}{PREFERRED_VIDEO_EXTENSION}')
         else:
             return (new_video_path, f'Transcode {current_name}{current_extension} to {current_name}{PREFERRED_VIDEO_EXTENSION}')
     elif operation == Operations.REMUX:
         if modify:
-            subprocess.run(args=['ffmpeg', '-i', video_path, '-c', 'copy', '-map', '0', new_video_path], check=True)
-            return (new_video_path, f'[REMUXED] {current_name}{current_extension} to {current_name}{PREFERRED_VIDEO_EXTENSION}\n\n\n')
+            if av is None or not _remux_inplace(video_path, new_video_path):
+                _run_encoder(['ffmpeg', '-i', video_path, '-c', 'copy', '-map', '0', new_video_path], new_video_path)
+            return (new_video_path, f'[REMUXED] {current_name}{current_extension} to {current_name}{PREFERRED_VIDEO_EXTENSION}')
         else:
             return (new_video_path, f'Remux {current_name}{current_extension} to {current_name}{PREFERRED_VIDEO_EXTENSION}')
 
-def delete_excess_files(folder_path, proper_video_path, modify=False):
+def _run_encoder(args, output_path):
+    # Encoder output goes to a file rather than a pipe so it never back-pressures the encoder;
+    # only its tail is read back, and only when the encode fails
+    output_existed = os.path.exists(output_path)
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            result = subprocess.run(args=args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr_file, check=False)
+        except FileNotFoundError:
+            raise AssertionError(f'{args[0]} not found')
+        if result.returncode:
+            if not output_existed:
+                _remove_partial_output(output_path)
+            stderr_file.seek(max(0, stderr_file.seek(0, os.SEEK_END) - 4096))
+            # Progress updates redraw a single line with \r, so only the text after the last \r is kept
+            stderr_lines = [line.rpartition('\r')[2].strip() for line in stderr_file.read().decode(errors='replace').split('\n')]
+            stderr_lines = [line for line in stderr_lines if line]
+            error = f'{args[0]} failed: exit {result.returncode}'
+            if stderr_lines:
+                error += '\n\t\t' + '\n\t\t'.join(stderr_lines[-ENCODER_ERROR_LINES:])
+            raise AssertionError(error)
+
+def _remux_inplace(video_path, new_video_path):
+    # Packets are handed straight from the demuxer to the muxer without decoding. Returns False when
+    # PyAV can't handle the file (e.g. a stream without a codec context) so the caller can fall back to ffmpeg.
+    # PyAV would overwrite an existing file, so that case is left to ffmpeg, which refuses to
+    if os.path.exists(new_video_path):
+        return False
+    try:
+        _mux_streams(video_path, new_video_path)
+    except (av.error.FFmpegError, ValueError, TypeError):
+        _remove_partial_output(new_video_path)
+        return False
+    return True
+
+def _remove_partial_output(output_path):
+    # A half-written video would otherwise be picked up as a second candidate on the next run.
+    # Callers only pass paths that did not exist before the encode started
+    try:
+        os.remove(output_path)
+    except FileNotFoundError:
+        pass
+
+def _mux_streams(video_path, new_video_path):
+    with av.open(video_path) as input_container, av.open(new_video_path, 'w') as output_container:
+        output_streams = dict()
+        for input_stream in input_container.streams:
+            if hasattr(output_container, 'add_stream_from_template'):
+                output_streams[input_stream.index] = output_container.add_stream_from_template(input_stream)
+            else:
+                output_streams[input_stream.index] = output_container.add_stream(template=input_stream)
+        for packet in input_container.demux():
+            # The demuxer yields an empty flush packet at the end of each stream
+            if packet.dts is None:
+                continue
+            packet.stream = output_streams[packet.stream.index]
+            output_container.mux(packet)
+
+def _probe_video_codec(video_path):
+    # A failed probe needs manual intervention; guessing would silently turn a cheap remux into a full transcode
+    try:
+        result = subprocess.run(
+            args=['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', video_path],
+            capture_output=True, text=True
+        )
+    except FileNotFoundError:
+        raise AssertionError('ffprobe not found; pass --transcode or --remux to skip codec detection')
+    if result.returncode != 0:
+        stderr_lines = result.stderr.strip().splitlines()
+        raise AssertionError(f'ffprobe failed: {stderr_lines[-1] if stderr_lines else f"exit {result.returncode}"}')
+    video_codec = result.stdout.strip()
+    assert video_codec, 'ffprobe found no video stream'
+    return video_codec
+
+def delete_excess_files(dir_entries, proper_video_path, renamed_paths=None, modify=False):
+    # dir_entries is scanned before renaming/converting, so renamed files are looked up by their
+    # original path and newly created files never appear in it.
+    # Entries are removed one at a time: parking the video elsewhere and clearing the whole folder
+    # saves no unlinks and strands the video if rmtree fails partway
+    renamed_paths = renamed_paths or dict()
     messages = []
-    for dir_entry in os.listdir(folder_path):
-        dir_entry_path = os.path.join(folder_path, dir_entry)
+    for dir_entry in dir_entries:
+        dir_entry_path = renamed_paths.get(dir_entry.path, dir_entry.path)
         if dir_entry_path != proper_video_path:
-            current_name, current_extension = os.path.splitext(os.path.basename(dir_entry_path))
+            dir_entry_name = os.path.basename(dir_entry_path)
             if modify:
-                if os.path.isdir(dir_entry_path):
+                if dir_entry.is_dir(follow_symlinks=False):
                     shutil.rmtree(dir_entry_path)
                 else:
                     os.remove(dir_entry_path)
-                messages.append(f'[DELETED] {current_name}{current_extension}')
+                messages.append(f'[DELETED] {dir_entry_name}')
             else:
-                messages.append(f'Delete {current_name}{current_extension}')
+                messages.append(f'Delete {dir_entry_name}')
     return messages
 
 if __name__ == '__main__':
@@ -2,4 +2,5 @@ from enum import Enum
 
 class Operations(Enum):
     TRANSCODE = 0
-    REMUX = 1
\ No newline at end of file
+    REMUX = 1
+    AUTO = 2
\ No newline at end of file